@@ -1,13 +1,15 @@
 import discord
 from discord import app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
 from flask import Flask, request, redirect
 import requests
 import json
 import os
 import asyncio
-from datetime import datetime
+import copy
+from datetime import datetime, timedelta, timezone
 import threading
+import time
 
 # CONFIGURAZIONE
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
@@ -20,8 +22,25 @@ REDIRECT_URI = f"{RAILWAY_URL}/callback"
 VERIFIED_ROLE_ID = 1271405086047993901
 ADMIN_ID = 1129411746495463467
 DATA_FILE = "bot_data.json"
+STATE_SAVE_INTERVAL = 60  # secondi tra un salvataggio delle modifiche non ancora scritte
 API_ENDPOINT = "https://discord.com/api/v10"
 
+# Sweeper dei token OAuth
+TOKEN_SWEEP_INTERVAL = 6 * 60 * 60  # secondi tra uno sweep e l'altro
+TOKEN_SWEEP_BATCH = 10  # token controllati per batch
+TOKEN_SWEEP_DELAY = 5  # pausa (secondi) tra un batch e l'altro
+
+# Outbox delle modifiche Discord
+OUTBOX_INTERVAL = 30  # secondi tra un giro del dispatcher e l'altro
+OUTBOX_RATE_DELAY = 1  # pausa (secondi) tra una richiesta e l'altra
+OUTBOX_BASE_DELAY = 30  # primo backoff (secondi), raddoppia a ogni tentativo
+OUTBOX_MAX_DELAY = 6 * 60 * 60
+OUTBOX_MAX_ATTEMPTS = 10
+
+# Statistiche giornaliere: ogni giorno è [verified, present, left, restored]
+DAILY_FIELDS = ["verified", "present", "left", "restored"]
+DAILY_HISTORY_DAYS = 365  # giorni conservati
+
 # Bot setup
 intents = discord.Intents.default()
 intents.members = True
@@ -35,19 +54,62 @@ tree = bot.tree
 app = Flask(__name__)
 
 def load_data():
+    loaded = {}
     if os.path.exists(DATA_FILE):
         with open(DATA_FILE, 'r') as f:
-            return json.load(f)
-    return {"verified_users": {}, "oauth_tokens": {}}
+            loaded = json.load(f)
+    # verifications: {guild_id: {user_id: {verified_at, in_server, checked_at}}}
+    # token_info: {user_id: {issued_at, expires_at}}
+    # outbox: {job_id: {kind, source, guild_id, user_id, attempts, next_attempt_at, created_at}}
+    # daily_stats: {guild_id: {present, days: {YYYY-MM-DD: [verified, present, left, restored]}}}
+    for key in ("verified_users", "oauth_tokens", "verifications", "token_info", "outbox", "daily_stats"):
+        loaded.setdefault(key, {})
+    return loaded
 
 def save_data(data):
-    with open(DATA_FILE, 'w') as f:
+    # Scrive su un file temporaneo e lo sostituisce: il file non resta mai a metà
+    tmp_file = f"{DATA_FILE}.tmp"
+    with open(tmp_file, 'w') as f:
         json.dump(data, f, indent=4)
+    os.replace(tmp_file, DATA_FILE)
 
-data = load_data()
+class DataStore:
+    """Stato condiviso tra bot e Flask: un solo writer alla volta, letture da snapshot.
+    
+    Ogni modifica lavora su una copia e poi la pubblica, quindi uno snapshot
+    non cambia mai sotto i piedi di chi lo sta leggendo (non va modificato).
+    """
+    def __init__(self, initial: dict):
+        self._state = initial
+        self._write_lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        # True se ci sono modifiche pubblicate ma non ancora scritte su file
+        self.dirty = False
+    
+    def snapshot(self) -> dict:
+        return self._state
+    
+    def update(self, mutator, persist: bool = True):
+        """Applica mutator(state) su una copia e la pubblica; restituisce il suo risultato"""
+        with self._write_lock:
+            new_state = copy.deepcopy(self._state)
+            result = mutator(new_state)
+            self._state = new_state
+            self.dirty = True
+        
+        if persist:
+            self.save()
+        return result
+    
+    def save(self):
+        with self._save_lock:
+            self.dirty = False
+            save_data(self._state)
+
+store = DataStore(load_data())
 
-def is_user_in_guild(guild_id: str, user_id: str) -> bool:
-    """Controlla se un utente è nel server"""
+def is_user_in_guild(guild_id: str, user_id: str):
+    """Controlla se un utente è nel server (None = esito sconosciuto)"""
     try:
         headers = {'Authorization': f'Bot {BOT_TOKEN}'}
         r = requests.get(
@@ -55,9 +117,322 @@ def is_user_in_guild(guild_id: str, user_id: str) -> bool:
             headers=headers,
             timeout=5
         )
-        return r.status_code == 200
     except:
+        return None
+    
+    if r.status_code == 200:
+        return True
+    if r.status_code == 404:
         return False
+    # Rate limit o errore di Discord: non dice niente sull'utente
+    return None
+
+def check_token(access_token: str):
+    """Controlla se un token OAuth è ancora valido (None = esito sconosciuto)"""
+    try:
+        headers = {'Authorization': f'Bearer {access_token}'}
+        r = requests.get(f'{API_ENDPOINT}/users/@me', headers=headers, timeout=5)
+    except:
+        return None
+    
+    if r.status_code == 200:
+        return True
+    if r.status_code == 401:
+        return False
+    # Rate limit o errore di Discord: riprova al prossimo sweep
+    return None
+
+def compact_data(state: dict) -> int:
+    """Rimuove duplicati e token di utenti non più verificati in nessun server"""
+    verified_ids = set()
+    for guild_id, users in list(state["verified_users"].items()):
+        state["verified_users"][guild_id] = list(dict.fromkeys(users))
+        verified_ids.update(users)
+        
+        meta = state["verifications"].get(guild_id, {})
+        for user_id in [u for u in meta if u not in users]:
+            del meta[user_id]
+    
+    orphaned = [user_id for user_id in state["oauth_tokens"] if user_id not in verified_ids]
+    for user_id in orphaned:
+        del state["oauth_tokens"][user_id]
+    
+    for user_id in [u for u in state["token_info"] if u not in state["oauth_tokens"]]:
+        del state["token_info"][user_id]
+    
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=DAILY_HISTORY_DAYS)).strftime("%Y-%m-%d")
+    for guild_stats in state["daily_stats"].values():
+        for day in [d for d in guild_stats["days"] if d < cutoff]:
+            del guild_stats["days"][day]
+    return len(orphaned)
+
+def ensure_daily_stats(state: dict, guild_id: str) -> dict:
+    """Restituisce le statistiche del server, inizializzando i presenti dallo stato noto"""
+    if guild_id not in state["daily_stats"]:
+        present = sum(
+            1 for info in state["verifications"].get(guild_id, {}).values()
+            if info.get("in_server") is True
+        )
+        state["daily_stats"][guild_id] = {"present": present, "days": {}}
+    return state["daily_stats"][guild_id]
+
+def record_daily_stat(state: dict, guild_id: str, field: str, amount: int = 1):
+    """Aggiorna il contatore di oggi; 'present' è il totale a fine giornata"""
+    guild_stats = ensure_daily_stats(state, guild_id)
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    entry = guild_stats["days"].setdefault(today, [0, guild_stats["present"], 0, 0])
+    
+    if field == "present":
+        guild_stats["present"] += amount
+        entry[1] = guild_stats["present"]
+    else:
+        entry[DAILY_FIELDS.index(field)] += amount
+
+def get_daily_history(state: dict, guild_id: str, days: int) -> list:
+    """Restituisce [(giorno, verified, present, left, restored)] degli ultimi N giorni.
+    
+    L'intervallo non parte mai prima del primo giorno registrato.
+    """
+    guild_days = state["daily_stats"].get(guild_id, {}).get("days", {})
+    if not guild_days:
+        return []
+    
+    today = datetime.now(timezone.utc).date()
+    first_day = datetime.strptime(min(guild_days), "%Y-%m-%d").date()
+    start = max(today - timedelta(days=days - 1), first_day)
+    start_key = start.strftime("%Y-%m-%d")
+    
+    # I giorni senza eventi mantengono i presenti del giorno prima
+    present = 0
+    for day in sorted(guild_days):
+        if day >= start_key:
+            break
+        present = guild_days[day][1]
+    
+    history = []
+    for offset in range((today - start).days + 1):
+        day = (start + timedelta(days=offset)).strftime("%Y-%m-%d")
+        verified_count, present, left, restored = guild_days.get(day, [0, present, 0, 0])
+        history.append((day, verified_count, present, left, restored))
+    return history
+
+def sparkline(values: list) -> str:
+    blocks = "▁▂▃▄▅▆▇█"
+    low, high = min(values), max(values)
+    span = (high - low) or 1
+    return "".join(blocks[(value - low) * (len(blocks) - 1) // span] for value in values)
+
+def remove_tokens(state: dict, dead_tokens: dict) -> int:
+    """Rimuove i token non validi, salvo quelli sostituiti da una nuova verifica"""
+    removed = 0
+    for user_id, access_token in dead_tokens.items():
+        if state["oauth_tokens"].get(user_id) == access_token:
+            del state["oauth_tokens"][user_id]
+            state["token_info"].pop(user_id, None)
+            removed += 1
+    return removed
+
+def set_member_states(state: dict, guild_id: str, states: dict):
+    """Aggiorna l'ultimo stato noto ({user_id: in_server}) degli utenti verificati nel server"""
+    verified_users_list = state["verified_users"].get(guild_id, [])
+    ensure_daily_stats(state, guild_id)
+    now = int(time.time())
+    for user_id, in_server in states.items():
+        # Esito sconosciuto (rate limit, errore): lo stato noto resta quello di prima
+        if in_server is None or user_id not in verified_users_list:
+            continue
+        info = state["verifications"].setdefault(guild_id, {}).setdefault(user_id, {})
+        was_in_server = info.get("in_server") is True
+        info["in_server"] = in_server
+        info["checked_at"] = now
+        
+        if in_server is True and not was_in_server:
+            record_daily_stat(state, guild_id, "present", 1)
+        elif was_in_server and in_server is not True:
+            record_daily_stat(state, guild_id, "present", -1)
+            record_daily_stat(state, guild_id, "left")
+
+def token_freshness(state: dict, user_id: str):
+    """Chiave di ordinamento: token più recenti prima, utenti senza token per ultimi"""
+    if user_id not in state["oauth_tokens"]:
+        return (0, 0)
+    return (1, state["token_info"].get(user_id, {}).get("expires_at", 0))
+
+def get_backup_candidates(state: dict, guild_id: str, verified_since=None, limit=None, only_missing=False):
+    """Restituisce (utenti da ripristinare, utenti saltati), i più probabili da aggiungere per primi"""
+    meta = state["verifications"].get(guild_id, {})
+    candidates = []
+    skipped = 0
+    
+    for user_id in state["verified_users"].get(guild_id, []):
+        info = meta.get(user_id, {})
+        if verified_since is not None and info.get("verified_at", 0) < verified_since:
+            continue
+        if only_missing and info.get("in_server") is True:
+            continue
+        # Senza token e fuori dal server non c'è niente da fare
+        if user_id not in state["oauth_tokens"] and info.get("in_server") is not True:
+            skipped += 1
+            continue
+        candidates.append(user_id)
+    
+    candidates.sort(key=lambda user_id: token_freshness(state, user_id), reverse=True)
+    if limit:
+        candidates = candidates[:limit]
+    return candidates, skipped
+
+def outbox_job_id(kind: str, guild_id: str, user_id: str) -> str:
+    return f"{kind}:{guild_id}:{user_id}"
+
+def enqueue_job(state: dict, kind: str, guild_id: str, user_id: str, source: str = "verify") -> str:
+    """Scrive una modifica Discord ('add_member' o 'add_role') nell'outbox, una sola per utente e tipo.
+    
+    Ogni nuova scrittura aumenta la generation del job: l'esito di un'esecuzione
+    partita prima viene ignorato da finish_job. Se il job esiste già mantiene
+    tentativi, origine e data di creazione, e viene solo anticipato ad adesso.
+    """
+    job_id = outbox_job_id(kind, guild_id, user_id)
+    job = state["outbox"].setdefault(job_id, {
+        "kind": kind,
+        "source": source,
+        "guild_id": guild_id,
+        "user_id": user_id,
+        "generation": 0,
+        "attempts": 0,
+        "created_at": int(time.time())
+    })
+    job["generation"] = job.get("generation", 0) + 1
+    job["next_attempt_at"] = 0
+    return job_id
+
+def retry_or_fail(r):
+    """Rate limit ed errori di Discord si riprovano, gli altri errori no.
+    
+    Restituisce (result, secondi da attendere secondo Retry-After).
+    """
+    if r.status_code != 429 and r.status_code < 500:
+        return "failed", 0
+    
+    try:
+        retry_after = float(r.headers.get("Retry-After", 0))
+    except ValueError:
+        retry_after = 0
+    return "retry", retry_after
+
+def execute_job(job: dict, access_token):
+    """Applica un job dell'outbox e restituisce (result, retry_after).
+    
+    result è 'joined', 'already_in', 'retry' o 'failed'. Entrambe le richieste
+    sono PUT idempotenti, quindi ripetere un job già applicato non fa danni.
+    """
+    guild_id = job["guild_id"]
+    user_id = job["user_id"]
+    headers = {
+        'Authorization': f'Bot {BOT_TOKEN}',
+        'Content-Type': 'application/json'
+    }
+    
+    try:
+        if job["kind"] == "add_member":
+            if not access_token:
+                return "failed", 0
+            
+            r = requests.put(
+                f'{API_ENDPOINT}/guilds/{guild_id}/members/{user_id}',
+                headers=headers,
+                json={'access_token': access_token, 'roles': [str(VERIFIED_ROLE_ID)]},
+                timeout=10
+            )
+            
+            if r.status_code == 201:
+                return "joined", 0
+            if r.status_code != 204:
+                print(f"[WARN] Failed to add user {user_id}: {r.status_code}")
+                return retry_or_fail(r)
+        
+        # Utente già nel server: aggiungi solo il ruolo, senza toccare gli altri
+        r = requests.put(
+            f'{API_ENDPOINT}/guilds/{guild_id}/members/{user_id}/roles/{VERIFIED_ROLE_ID}',
+            headers=headers,
+            timeout=10
+        )
+        
+        if r.status_code in [200, 204]:
+            return "already_in", 0
+        print(f"[WARN] Could not add role to user {user_id}: {r.status_code}")
+        return retry_or_fail(r)
+    except Exception as e:
+        print(f"[ERROR] Discord request failed for {user_id}: {e}")
+        return "retry", 0
+
+def finish_job(state: dict, job_id: str, result: str, generation: int, retry_after: float = 0):
+    """Rimuove il job completato o lo ripianifica con backoff esponenziale"""
+    job = state["outbox"].get(job_id)
+    # Job riscritto mentre era in esecuzione: l'esito riguarda la versione vecchia
+    if job is None or job.get("generation", 0) != generation:
+        return
+    
+    if result in ["joined", "already_in"]:
+        del state["outbox"][job_id]
+        set_member_states(state, job["guild_id"], {job["user_id"]: True})
+        if result == "joined" and job.get("source") == "backup":
+            record_daily_stat(state, job["guild_id"], "restored")
+        return
+    
+    job["attempts"] += 1
+    if result == "failed" or job["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+        print(f"[WARN] Giving up on {job_id} after {job['attempts']} attempts")
+        del state["outbox"][job_id]
+        return
+    
+    delay = min(OUTBOX_BASE_DELAY * 2 ** (job["attempts"] - 1), OUTBOX_MAX_DELAY)
+    # Con un 429 non riprovare prima di quanto chiede Discord
+    job["next_attempt_at"] = int(time.time() + max(delay, retry_after))
+
+def finish_jobs(state: dict, results: dict):
+    """Registra in un'unica modifica gli esiti ({job_id: (result, generation, retry_after)}) di più job"""
+    for job_id, outcome in results.items():
+        finish_job(state, job_id, *outcome)
+
+# Job che qualcuno sta già eseguendo (callback, /backup o dispatcher): gli altri li saltano
+jobs_in_flight = set()
+jobs_in_flight_lock = threading.Lock()
+
+def reserve_jobs(job_ids: list) -> set:
+    """Prenota i job non ancora in esecuzione e restituisce quelli prenotati"""
+    with jobs_in_flight_lock:
+        reserved = set(job_ids) - jobs_in_flight
+        jobs_in_flight.update(reserved)
+    return reserved
+
+def release_jobs(job_ids):
+    with jobs_in_flight_lock:
+        jobs_in_flight.difference_update(job_ids)
+
+def execute_pending_job(job_id: str):
+    """Esegue un job dell'outbox senza registrarne l'esito.
+    
+    Restituisce (result, generation, retry_after), oppure None se il job non c'è più.
+    """
+    snapshot = store.snapshot()
+    job = snapshot["outbox"].get(job_id)
+    if job is None:
+        return None
+    result, retry_after = execute_job(job, snapshot["oauth_tokens"].get(job["user_id"]))
+    return result, job.get("generation", 0), retry_after
+
+def run_job(job_id: str):
+    """Esegue subito un job dell'outbox e ne registra l'esito.
+    
+    Restituisce (result, retry_after); result è 'skipped' se il job non c'è più.
+    """
+    outcome = execute_pending_job(job_id)
+    if outcome is None:
+        return "skipped", 0
+    
+    store.update(lambda state: finish_job(state, job_id, *outcome))
+    result, _, retry_after = outcome
+    return result, retry_after
 
 class VerifyButton(discord.ui.View):
     def __init__(self):
@@ -69,7 +444,7 @@ class VerifyButton(discord.ui.View):
         guild_id = str(interaction.guild.id)
         
         # Controlla se già verificato
-        if guild_id in data["verified_users"] and user_id in data["verified_users"][guild_id]:
+        if user_id in store.snapshot()["verified_users"].get(guild_id, []):
             await interaction.response.send_message("✅ You are already verified!", ephemeral=True)
             return
         
@@ -103,13 +478,22 @@ async def setupverify(interaction: discord.Interaction):
     await interaction.response.send_message("✅ Verification system setup complete!", ephemeral=True)
 
 @tree.command(name="verified", description="Show verified members statistics")
-async def verified(interaction: discord.Interaction):
+@app_commands.describe(history="Show the daily trend of the last N days instead of checking members")
+async def verified(
+    interaction: discord.Interaction,
+    history: app_commands.Range[int, 1, DAILY_HISTORY_DAYS] = None
+):
     if interaction.user.id != ADMIN_ID:
         await interaction.response.send_message("❌ You don't have permission!", ephemeral=True)
         return
     
     guild_id = str(interaction.guild.id)
-    verified_users_list = data["verified_users"].get(guild_id, [])
+    
+    if history:
+        await verified_history(interaction, guild_id, history)
+        return
+    
+    verified_users_list = store.snapshot()["verified_users"].get(guild_id, [])
     
     if not verified_users_list:
         await interaction.response.send_message("❌ No verified users found!", ephemeral=True)
@@ -129,16 +513,23 @@ async def verified(interaction: discord.Interaction):
     # Controlla quanti sono ancora nel server
     in_server = 0
     left_server = 0
+    unknown = 0
+    states = {}
     
     for user_id in verified_users_list:
-        if is_user_in_guild(guild_id, user_id):
+        states[user_id] = is_user_in_guild(guild_id, user_id)
+        if states[user_id] is True:
             in_server += 1
-        else:
+        elif states[user_id] is False:
             left_server += 1
+        else:
+            unknown += 1
         
         # Pausa per evitare rate limit
         await asyncio.sleep(0.3)
     
+    await asyncio.to_thread(store.update, lambda state: set_member_states(state, guild_id, states))
+    
     # Crea l'embed finale
     embed = discord.Embed(
         title="📊 Verified Members Statistics",
@@ -164,8 +555,16 @@ async def verified(interaction: discord.Interaction):
         inline=True
     )
     
-    # Calcola percentuale
-    percentage = (in_server / total * 100) if total > 0 else 0
+    if unknown > 0:
+        embed.add_field(
+            name="❓ Not Checked",
+            value=f"**{unknown}** members (Discord errors)",
+            inline=True
+        )
+    
+    # Calcola percentuale sui soli utenti controllati
+    checked = in_server + left_server
+    percentage = (in_server / checked * 100) if checked > 0 else 0
     
     embed.add_field(
         name="📈 Retention Rate",
@@ -177,17 +576,98 @@ async def verified(interaction: discord.Interaction):
     
     await message.edit(embed=embed)
 
+async def verified_history(interaction: discord.Interaction, guild_id: str, days: int):
+    """Mostra l'andamento giornaliero dalle statistiche aggregate, senza chiamate API"""
+    snapshot = store.snapshot()
+    history = get_daily_history(snapshot, guild_id, days)
+    if not history:
+        await interaction.response.send_message("❌ No history recorded yet!", ephemeral=True)
+        return
+    
+    present_values = [present for _, _, present, _, _ in history]
+    total = len(snapshot["verified_users"].get(guild_id, []))
+    
+    embed = discord.Embed(
+        title="📈 Verified Members History",
+        description=(
+            f"Members in server, {history[0][0]} → {history[-1][0]} ({len(history)} days)\n"
+            f"```{sparkline(present_values)}```"
+        ),
+        color=0x3498DB
+    )
+    
+    embed.add_field(
+        name="📝 New Verified",
+        value=f"**{sum(row[1] for row in history)}** members",
+        inline=True
+    )
+    
+    embed.add_field(
+        name="❌ Left Server",
+        value=f"**{sum(row[3] for row in history)}** members",
+        inline=True
+    )
+    
+    embed.add_field(
+        name="🔄 Restored by Backup",
+        value=f"**{sum(row[4] for row in history)}** members",
+        inline=True
+    )
+    
+    embed.add_field(
+        name="✅ In Server",
+        value=f"**{present_values[0]}** → **{present_values[-1]}** members",
+        inline=True
+    )
+    
+    percentage = (present_values[-1] / total * 100) if total > 0 else 0
+    
+    embed.add_field(
+        name="📈 Retention Rate",
+        value=f"**{percentage:.1f}%**",
+        inline=True
+    )
+    
+    embed.set_footer(text=f"Axira Verification System • {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC")
+    
+    await interaction.response.send_message(embed=embed)
+
 @tree.command(name="backup", description="Add all verified members to the server")
-async def backup(interaction: discord.Interaction):
+@app_commands.describe(
+    verified_since="Only users verified on or after this date (YYYY-MM-DD)",
+    limit="Maximum number of users to process",
+    only_missing="Skip users last seen in the server"
+)
+async def backup(
+    interaction: discord.Interaction,
+    verified_since: str = None,
+    limit: app_commands.Range[int, 1] = None,
+    only_missing: bool = False
+):
     if interaction.user.id != ADMIN_ID:
         await interaction.response.send_message("❌ You don't have permission!", ephemeral=True)
         return
     
+    since_ts = None
+    if verified_since:
+        try:
+            since_ts = datetime.strptime(verified_since, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+        except ValueError:
+            await interaction.response.send_message("❌ Invalid date! Use the format YYYY-MM-DD", ephemeral=True)
+            return
+    
     guild_id = str(interaction.guild.id)
-    verified_users_list = data["verified_users"].get(guild_id, [])
+    # Ordinati per freschezza del token: prima chi ha più probabilità di rientrare
+    verified_users_list, skipped = get_backup_candidates(store.snapshot(), guild_id, since_ts, limit, only_missing)
     
     if not verified_users_list:
-        await interaction.response.send_message("❌ No verified users found!", ephemeral=True)
+        if skipped > 0:
+            await interaction.response.send_message(
+                f"❌ No users to restore! {skipped} skipped (no valid token and not in server)",
+                ephemeral=True
+            )
+        else:
+            await interaction.response.send_message("❌ No verified users found!", ephemeral=True)
         return
     
     total = len(verified_users_list)
@@ -204,78 +684,75 @@ async def backup(interaction: discord.Interaction):
     joined = 0
     already_in = 0
     failed = 0
+    queued = 0
+    in_progress = 0
     
-    for i, user_id in enumerate(verified_users_list):
-        access_token = data["oauth_tokens"].get(user_id)
-        
-        # Controlla se l'utente è già nel server
-        is_in_server = is_user_in_guild(guild_id, user_id)
+    # Con il token si può aggiungere l'utente, altrimenti solo dargli il ruolo
+    oauth_tokens = store.snapshot()["oauth_tokens"]
+    jobs = [
+        ("add_member" if user_id in oauth_tokens else "add_role", user_id)
+        for user_id in verified_users_list
+    ]
+    job_ids = [outbox_job_id(kind, guild_id, user_id) for kind, user_id in jobs]
+    
+    # Prenota i job prima di pubblicarli, così il dispatcher non li esegue in parallelo
+    reserved = reserve_jobs(job_ids)
+    # Esiti ancora da registrare: si applicano tutti insieme a ogni aggiornamento
+    results = {}
+    
+    try:
+        # Scrivi prima tutte le modifiche nell'outbox: se il bot si riavvia, il dispatcher le riprende
+        await asyncio.to_thread(store.update, lambda state: [
+            enqueue_job(state, kind, guild_id, user_id, source="backup") for kind, user_id in jobs
+        ])
         
-        if is_in_server:
-            # Utente già nel server, prova solo ad aggiungere il ruolo
-            already_in += 1
+        for i, job_id in enumerate(job_ids):
+            # I job che qualcun altro sta già eseguendo non si ripetono
+            outcome = None
+            if job_id in reserved:
+                outcome = await asyncio.to_thread(execute_pending_job, job_id)
+            # Job già completato o in corso altrove: contato a parte
+            result = None
+            retry_after = 0
+            if outcome is not None:
+                results[job_id] = outcome
+                result, _, retry_after = outcome
             
-            headers = {
-                'Authorization': f'Bot {BOT_TOKEN}',
-                'Content-Type': 'application/json'
-            }
-            
-            try:
-                r = requests.patch(
-                    f'{API_ENDPOINT}/guilds/{guild_id}/members/{user_id}',
-                    headers=headers,
-                    json={'roles': [str(VERIFIED_ROLE_ID)]},
-                    timeout=10
-                )
-                
-                if r.status_code not in [200, 204]:
-                    print(f"[WARN] Could not add role to user {user_id}: {r.status_code}")
-            except Exception as e:
-                print(f"[ERROR] Role assignment failed for {user_id}: {e}")
-        
-        elif access_token:
-            # Utente non nel server, prova ad aggiungerlo
-            headers = {
-                'Authorization': f'Bot {BOT_TOKEN}',
-                'Content-Type': 'application/json'
-            }
+            if result == "joined":
+                joined += 1
+            elif result == "already_in":
+                already_in += 1
+            elif result == "retry":
+                queued += 1
+            elif result == "failed":
+                failed += 1
+            else:
+                # Job già completato o in esecuzione altrove (callback o dispatcher)
+                in_progress += 1
             
-            payload = {
-                'access_token': access_token,
-                'roles': [str(VERIFIED_ROLE_ID)]
-            }
+            # Con un 429 aspetta quanto chiede Discord prima della prossima richiesta
+            if outcome is not None:
+                await asyncio.sleep(max(1, retry_after))
             
-            try:
-                r = requests.put(
-                    f'{API_ENDPOINT}/guilds/{guild_id}/members/{user_id}',
-                    headers=headers,
-                    json=payload,
-                    timeout=10
+            # Aggiorna ogni 5 utenti o all'ultimo
+            if (i + 1) % 5 == 0 or (i + 1) == total:
+                batch, results = results, {}
+                await asyncio.to_thread(store.update, lambda state: finish_jobs(state, batch))
+                release_jobs(reserved.intersection(job_ids[:i + 1]))
+                progress = i + 1
+                embed.description = (
+                    f"**Progress:** {progress}/{total} processed\n\n"
+                    f"**✅ Joined:** {joined}\n"
+                    f"**📍 Already in server:** {already_in}\n"
+                    f"**⏳ Queued for retry:** {queued}\n"
+                    f"**🔁 Already in progress:** {in_progress}\n"
+                    f"**❌ Failed:** {failed}"
                 )
-                
-                if r.status_code in [201, 204]:
-                    joined += 1
-                else:
-                    failed += 1
-                    print(f"[WARN] Failed to add user {user_id}: {r.status_code}")
-            except Exception as e:
-                failed += 1
-                print(f"[ERROR] Failed to add user {user_id}: {e}")
-        else:
-            failed += 1
-        
-        await asyncio.sleep(1)
-        
-        # Aggiorna ogni 5 utenti o all'ultimo
-        if (i + 1) % 5 == 0 or (i + 1) == total:
-            progress = i + 1
-            embed.description = (
-                f"**Progress:** {progress}/{total} processed\n\n"
-                f"**✅ Joined:** {joined}\n"
-                f"**📍 Already in server:** {already_in}\n"
-                f"**❌ Failed:** {failed}"
-            )
-            await message.edit(embed=embed)
+                await message.edit(embed=embed)
+    finally:
+        if results:
+            await asyncio.to_thread(store.update, lambda state: finish_jobs(state, results))
+        release_jobs(reserved)
     
     # Messaggio finale
     embed.color = 0x00FF00
@@ -287,6 +764,15 @@ async def backup(interaction: discord.Interaction):
         f"**📍 Already in server:** {already_in} members"
     ]
     
+    if skipped > 0:
+        summary_lines.append(f"**⏭️ Skipped:** {skipped} members (no valid token and not in server)")
+    
+    if queued > 0:
+        summary_lines.append(f"**⏳ Queued for retry:** {queued} members (Discord errors, retried automatically)")
+    
+    if in_progress > 0:
+        summary_lines.append(f"**🔁 Already in progress:** {in_progress} members (handled by another verification or retry)")
+    
     if failed > 0:
         summary_lines.append(f"**❌ Failed:** {failed} members (expired tokens or errors)")
     
@@ -295,6 +781,73 @@ async def backup(interaction: discord.Interaction):
     
     await message.edit(embed=embed)
 
+@tasks.loop(seconds=TOKEN_SWEEP_INTERVAL)
+async def token_sweeper():
+    """Valida i token salvati a batch e rimuove quelli revocati o scaduti"""
+    snapshot = store.snapshot()
+    user_ids = list(snapshot["oauth_tokens"].keys())
+    dead_tokens = {}
+    now = time.time()
+    
+    for start in range(0, len(user_ids), TOKEN_SWEEP_BATCH):
+        for user_id in user_ids[start:start + TOKEN_SWEEP_BATCH]:
+            access_token = snapshot["oauth_tokens"][user_id]
+            
+            expires_at = snapshot["token_info"].get(user_id, {}).get("expires_at")
+            if expires_at and expires_at < now:
+                valid = False
+            else:
+                valid = await asyncio.to_thread(check_token, access_token)
+            
+            if valid is False:
+                dead_tokens[user_id] = access_token
+        
+        # Bassa priorità: lascia spazio al resto del bot
+        await asyncio.sleep(TOKEN_SWEEP_DELAY)
+    
+    revoked, orphaned = await asyncio.to_thread(
+        store.update, lambda state: (remove_tokens(state, dead_tokens), compact_data(state))
+    )
+    
+    print(f"[SWEEP] Checked {len(user_ids)} tokens: {revoked} revoked/expired, {orphaned} orphaned removed")
+
+@token_sweeper.before_loop
+async def before_token_sweeper():
+    await bot.wait_until_ready()
+
+@tasks.loop(seconds=OUTBOX_INTERVAL)
+async def outbox_dispatcher():
+    """Riprova le modifiche Discord in sospeso, anche quelle rimaste da prima di un riavvio"""
+    now = time.time()
+    due = [
+        job_id for job_id, job in store.snapshot()["outbox"].items()
+        if job["next_attempt_at"] <= now and job_id not in jobs_in_flight
+    ]
+    
+    for job_id in due:
+        if not reserve_jobs([job_id]):
+            continue
+        
+        try:
+            result, retry_after = await asyncio.to_thread(run_job, job_id)
+        finally:
+            release_jobs([job_id])
+        if result in ["joined", "already_in"]:
+            print(f"[INFO] Outbox job {job_id} applied")
+        
+        # Rate limit (con un 429 aspetta quanto chiede Discord)
+        await asyncio.sleep(max(OUTBOX_RATE_DELAY, retry_after))
+
+@outbox_dispatcher.before_loop
+async def before_outbox_dispatcher():
+    await bot.wait_until_ready()
+
+@tasks.loop(seconds=STATE_SAVE_INTERVAL)
+async def state_saver():
+    """Scrive su file le modifiche salvate con persist=False"""
+    if store.dirty:
+        await asyncio.to_thread(store.save)
+
 # Variabile per tracciare se il view è già stato aggiunto
 view_added = False
 
@@ -307,6 +860,15 @@ async def on_ready():
         bot.add_view(VerifyButton())
         view_added = True
     
+    if not token_sweeper.is_running():
+        token_sweeper.start()
+    
+    if not outbox_dispatcher.is_running():
+        outbox_dispatcher.start()
+    
+    if not state_saver.is_running():
+        state_saver.start()
+    
     await tree.sync()
     print("="*60)
     print(f'✅ Bot online: {bot.user}')
@@ -314,9 +876,32 @@ async def on_ready():
     print(f'🌐 Server URL: {RAILWAY_URL}')
     print(f'🔗 Redirect URI: {REDIRECT_URI}')
     print(f'🔧 Commands synced!')
-    print(f'💾 Verified users saved: {sum(len(users) for users in data["verified_users"].values())}')
+    print(f'💾 Verified users saved: {sum(len(users) for users in store.snapshot()["verified_users"].values())}')
     print("="*60)
 
+async def update_member_state(member: discord.Member, in_server: bool):
+    """Registra un ingresso/uscita di un utente verificato, solo se lo stato cambia"""
+    guild_id = str(member.guild.id)
+    user_id = str(member.id)
+    snapshot = store.snapshot()
+    if user_id not in snapshot["verified_users"].get(guild_id, []):
+        return
+    if snapshot["verifications"].get(guild_id, {}).get(user_id, {}).get("in_server") is in_server:
+        return
+    
+    # La copia dello stato non deve bloccare il gateway; il file lo scrive state_saver
+    await asyncio.to_thread(
+        store.update, lambda state: set_member_states(state, guild_id, {user_id: in_server}), False
+    )
+
+@bot.event
+async def on_member_join(member: discord.Member):
+    await update_member_state(member, True)
+
+@bot.event
+async def on_member_remove(member: discord.Member):
+    await update_member_state(member, False)
+
 # Web server routes
 @app.route('/')
 def home():
@@ -529,6 +1114,7 @@ def callback():
         r.raise_for_status()
         token_response = r.json()
         access_token = token_response['access_token']
+        issued_at = int(time.time())
         
         # Get user info
         headers = {'Authorization': f'Bearer {access_token}'}
@@ -540,42 +1126,37 @@ def callback():
         
         print(f"[INFO] User {username} ({user_id}) is verifying for guild {guild_id}")
         
-        # Prova ad aggiungere l'utente al server
-        headers = {
-            'Authorization': f'Bot {BOT_TOKEN}',
-            'Content-Type': 'application/json'
-        }
-        payload = {
-            'access_token': access_token,
-            'roles': [str(VERIFIED_ROLE_ID)]
-        }
-        
-        r = requests.put(
-            f'{API_ENDPOINT}/guilds/{guild_id}/members/{user_id}',
-            headers=headers,
-            json=payload
-        )
-        
-        print(f"[INFO] PUT /members response: {r.status_code}")
-        
-        # Se l'utente è già nel server (status 204 o errore), prova a dargli solo il ruolo
-        if r.status_code == 204 or r.status_code >= 400:
-            print(f"[INFO] User already in server, adding role only...")
-            r = requests.patch(
-                f'{API_ENDPOINT}/guilds/{guild_id}/members/{user_id}',
-                headers=headers,
-                json={'roles': [str(VERIFIED_ROLE_ID)]}
-            )
-            print(f"[INFO] PATCH /members response: {r.status_code}")
-        
         # Salva i dati SEMPRE (persistente) - NON ELIMINA DATI VECCHI!
-        if guild_id not in data["verified_users"]:
-            data["verified_users"][guild_id] = []
-        if user_id not in data["verified_users"][guild_id]:
-            data["verified_users"][guild_id].append(user_id)
+        def save_verification(state):
+            if guild_id not in state["verified_users"]:
+                state["verified_users"][guild_id] = []
+            if user_id not in state["verified_users"][guild_id]:
+                state["verified_users"][guild_id].append(user_id)
+                record_daily_stat(state, guild_id, "verified")
+            
+            state["oauth_tokens"][user_id] = access_token
+            state["token_info"][user_id] = {
+                "issued_at": issued_at,
+                "expires_at": issued_at + int(token_response.get('expires_in', 604800))
+            }
+            
+            meta = state["verifications"].setdefault(guild_id, {}).setdefault(user_id, {})
+            meta["verified_at"] = issued_at
+            
+            # Aggiunta al server e ruolo passano dall'outbox, salvati insieme alla verifica
+            enqueue_job(state, "add_member", guild_id, user_id)
         
-        data["oauth_tokens"][user_id] = access_token
-        save_data(data)
+        # Prenota il job prima di pubblicarlo, così il dispatcher non lo esegue in parallelo
+        job_id = outbox_job_id("add_member", guild_id, user_id)
+        reserved = reserve_jobs([job_id])
+        try:
+            store.update(save_verification)
+            
+            # Prova subito; se Discord fallisce ci riprova il dispatcher
+            result = run_job(job_id)[0] if reserved else "queued"
+        finally:
+            release_jobs(reserved)
+        print(f"[INFO] Add member/role result: {result}")
         
         print(f"[SUCCESS] User {username} verified and saved!")
         